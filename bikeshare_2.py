@@ -1,12 +1,73 @@
+import contextlib
+import os
 import time
-import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pv
+import pyarrow.feather as feather
 import calendar
 from datetime import datetime, timedelta
 
+try:
+    from numba import get_num_threads, njit, prange
+except ImportError:
+    njit = None
+
 CITY_DATA = {'chicago': 'chicago.csv',
              'new york': 'new_york_city.csv',
              'washington': 'washington.csv'}
 
+# all columns are read since display_data shows the raw trip rows, the repeated strings are
+# dictionary encoded by the reader and arrive in pandas as categories, so value_counts and the
+# station groupby count small integer codes; types given for columns a file lacks (Gender) are ignored
+_CATEGORY_TYPE = pa.dictionary(pa.int32(), pa.string())
+_CSV_OPTIONS = pv.ConvertOptions(
+    column_types={'Start Time': pa.timestamp('s'), 'Start Station': _CATEGORY_TYPE,
+                  'End Station': _CATEGORY_TYPE, 'User Type': _CATEGORY_TYPE, 'Gender': _CATEGORY_TYPE},
+    strings_can_be_null=True)
+
+# month names accepted by the month filter and their month number
+_MONTH_IDX = {'january': 1, 'february': 2, 'march': 3, 'april': 4, 'may': 5, 'june': 6}
+
+# day of week names indexed by their pandas dayofweek number (Monday is 0)
+_DAY_NAMES = tuple(calendar.day_name)
+_DAY_IDX = {name.lower(): i for i, name in enumerate(_DAY_NAMES)}
+
+# accepted answers to the yes or no questions
+_YES = frozenset({'y', 'yes', 'ye'})
+_NO = frozenset({'n', 'no'})
+
+# 12-hour clock labels indexed by the hour of day
+_HOUR_LABELS = tuple(datetime.strptime(f"{hour}:00", '%H:%M').strftime('%I:%M %p') for hour in range(24))
+
+if njit is not None:
+    @njit(parallel=True, cache=True)
+    def _parallel_bincount(values, size, n_chunks):
+        # each chunk is counted on its own, the partial counts are added up afterwards
+        chunk = (values.size + n_chunks - 1) // n_chunks
+        counts = np.zeros((n_chunks, size), np.int64)
+        for c in prange(n_chunks):
+            for i in range(c * chunk, min((c + 1) * chunk, values.size)):
+                counts[c, values[i]] += 1
+        return counts.sum(axis=0)
+
+    def _mode_small(values, size):
+        """Returns the most common value of an array holding integers in [0, size)."""
+        return _parallel_bincount(values, size, get_num_threads()).argmax()
+else:
+    def _mode_small(values, size):
+        """Returns the most common value of an array holding integers in [0, size)."""
+        return np.bincount(values, minlength=size).argmax()
+
+
+# version of the columns stored in the Feather copies of the city files, bumped whenever
+# read_city changes them so copies written by an older version are parsed again
+_FEATHER_VERSION = b'2'
+
+# computed statistics keyed by (city, month, day), reused when the same selection is made again
+_STATS_CACHE: dict[tuple, dict] = {}
+
 
 def get_city():
     """
@@ -17,17 +78,11 @@ def get_city():
     """
 
     while True:
-        try:
-            city: str = input("Select the CITY you would like to check: Chicago, New York, "
-                              "or Washington)\n")
-            if city.lower() not in ['chicago', 'new york', 'washington']:
-                raise ValueError
-            break
-        except ValueError:
-            print(f"Results cannot be filtered by \"{city}\". Please select a valid city!\n")
-            continue
-
-    return city.lower()
+        city: str = input("Select the CITY you would like to check: Chicago, New York, "
+                          "or Washington)\n").strip().lower()
+        if city in CITY_DATA:
+            return city
+        print(f"Results cannot be filtered by \"{city}\". Please select a valid city!\n")
 
 
 def check_prompt(prompt_text: str):
@@ -40,15 +95,12 @@ def check_prompt(prompt_text: str):
         (bool) answer - User answer as boolean
     """
     while True:
-        try:
-            answer = input(prompt_text)
-            if answer.lower() in ['y', 'yes', 'ye']:
-                return True
-            if answer.lower() in ['n', 'no']:
-                return False
-            raise Exception
-        except Exception:
-            print("Invalid response!\n")
+        answer = input(prompt_text).strip().lower()
+        if answer in _YES:
+            return True
+        if answer in _NO:
+            return False
+        print("Invalid response!\n")
 
 
 def get_filters():
@@ -65,188 +117,238 @@ def get_filters():
     month: str = ""
     if check_prompt(f"Would you like to filter by MONTH? y/n\n"):
         while True:
-            try:
-                month = input("What MONTH would you like to filter by? (january, february, march, april, may, "
-                              "or june')\n")
-                if month.lower() not in ['january', 'february', 'march', 'april', 'may', 'june']:
-                    raise Exception
+            month = input("What MONTH would you like to filter by? (january, february, march, april, may, "
+                          "or june')\n").strip().lower()
+            if month in _MONTH_IDX:
                 break
-            except Exception:
-                print(f"Results cannot be filtered by \"{month}\", please select a valid month!\n")
-                continue
+            print(f"Results cannot be filtered by \"{month}\", please select a valid month!\n")
 
     # get user input for day of week (all, monday, tuesday, ... sunday)
     day: str = ""
     if check_prompt("Would you like to filter by DAY OF WEEK? y/n\n"):
         while True:
-            try:
-                day = input("What day of week would you like to filter by? (Monday, Tues...')\n")
-                if day.lower() not in ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'sunday']:
-                    raise Exception
+            day = input("What day of week would you like to filter by? (Monday, Tues...')\n").strip().lower()
+            if day in _DAY_IDX:
                 break
-            except Exception:
-                print(f"Results cannot be filtered by \"{day}\", select a valid day!\n")
-                continue
+            print(f"Results cannot be filtered by \"{day}\", select a valid day!\n")
 
     print('-' * 60)
-    return month.lower(), day.lower()
+    return month, day
 
 
-def load_data(city):
+def read_city(city):
     """
-    Loads data for the specified city and filters by month and day if applicable.
+    Reads the data of the specified city with the month, day of week and hour columns added.
+
+    The first read parses the CSV file and writes the result next to it as a Feather file,
+    which is read instead as long as it is newer than the CSV file, can be read and holds the
+    columns of the current _FEATHER_VERSION.
 
     Args:
         (str) city - name of the city to analyze
-        (str) month - name of the month to filter by
-        (str) day - name of the day of week to filter by.
     Returns:
-        df - Pandas DataFrame containing city data filtered by month and day
+        table - PyArrow Table containing the city data
     """
-    df = pd.read_csv(CITY_DATA[city])
-
-    # convert the Start Time column to datetime
-    df['Start Time'] = pd.to_datetime(df['Start Time'])
-
-    # extract month and day of week from Start Time to create new columns
-    df['month'] = df['Start Time'].dt.month
-    df['day_of_week'] = df['Start Time'].dt.day_name()
-    df['hour'] = df['Start Time'].dt.hour
-
-    return df
-
-
-def filter_data(df, filters: tuple):
+    csv_path = CITY_DATA[city]
+    feather_path = os.path.splitext(csv_path)[0] + '.feather'
+    if os.path.exists(feather_path) and os.path.getmtime(feather_path) >= os.path.getmtime(csv_path):
+        # a damaged or outdated copy is ignored, the CSV file is parsed again and the copy rewritten
+        try:
+            table = feather.read_table(feather_path, memory_map=True)
+        except (pa.ArrowInvalid, OSError):
+            table = None
+        if table is not None and (table.schema.metadata or {}).get(b'bikeshare_version') == _FEATHER_VERSION:
+            return table
+
+    # Start Time is parsed while reading, the unnamed trip id column gets the name pandas gives it
+    table = pv.read_csv(csv_path, convert_options=_CSV_OPTIONS)
+    table = table.rename_columns([name or 'Unnamed: 0' for name in table.column_names])
+
+    # extract month, day of week and hour from Start Time to create new columns,
+    # all derived from the raw datetime64 values instead of one .dt pass each
+    start = table['Start Time'].to_numpy()
+    days = start.astype('datetime64[D]')
+    table = table.append_column('month', pa.array(
+        (days.astype('datetime64[M]').astype('int64') % 12 + 1).astype('int8')))
+    # 1970-01-01 was a Thursday, dayofweek 3
+    table = table.append_column('day_of_week', pa.array(((days.astype('int64') + 3) % 7).astype('int8')))
+    table = table.append_column('hour', pa.array(
+        (start.astype('datetime64[h]').astype('int64') % 24).astype('int8')))
+
+    table = table.replace_schema_metadata({b'bikeshare_version': _FEATHER_VERSION})
+
+    # the Feather copy only speeds up the next runs, so a read-only data folder is fine; it is
+    # written to a temporary file first so an interrupted write never leaves a partial copy, and
+    # left uncompressed so reading it memory-maps the columns without decompressing them
+    tmp_path = feather_path + '.tmp'
+    try:
+        feather.write_feather(table, tmp_path, compression='uncompressed')
+        os.replace(tmp_path, feather_path)
+    except OSError:
+        with contextlib.suppress(OSError):
+            os.remove(tmp_path)
+
+    return table
+
+
+def filter_data(table, filters: tuple):
     """
-    Filters the data based on selected filters.
+    Filters the city data by month and day if applicable.
 
     Args:
-        (str) month - name of the month to filter by, or "all" to apply no month filter
-        (str) day - name of the day of week to filter by, or "all" to apply no day filter
+        table - PyArrow Table containing the city data, as returned by read_city
+        (tuple) filters - name of the month and of the day of week to filter by, "" to apply no filter
     Returns:
-        df - Pandas DataFrame containing city data filtered by month and/or day
+        df - Pandas DataFrame containing city data filtered by month and day
     """
-
     month, day = filters
-    # filter by month if applicable
-    if month:
-        # use the index of the months list to get the corresponding int
-        months = ['january', 'february', 'march', 'april', 'may', 'june']
-        month = months.index(month) + 1
-
-        # filter by month to create the new dataframe
-        df = df[df['month'] == month]
+    # filter by month and day of week before converting, so the other rows never reach pandas
+    if month or day:
+        mask = pa.scalar(True)
+        if month:
+            mask = pc.and_(mask, pc.equal(table['month'], _MONTH_IDX[month]))
+        if day:
+            mask = pc.and_(mask, pc.equal(table['day_of_week'], _DAY_IDX[day]))
+        # the selected row numbers become the index, so the rows keep their number in the file
+        rows = pc.indices_nonzero(mask)
+        df = table.take(rows).to_pandas(split_blocks=True)
+        df.index = rows.to_numpy()
+        return df
+
+    # the table is not converted with self_destruct, main keeps the unfiltered one for the next run
+    return table.to_pandas(split_blocks=True)
+
+
+def compute_stats(df, key: tuple):
+    """
+    Computes all the statistics displayed to the user for the selected data.
 
-    # filter by day of week if applicable
-    if day:
-        # filter by day of week to create the new dataframe
-        df = df[df['day_of_week'] == day.title()]
+    Args:
+        df - Pandas DataFrame containing city data filtered by month and/or day
+        (tuple) key - city, month and day used to load and filter the data
+    Returns:
+        (dict) stats - statistics read by the *_stats display functions
+    """
+    if key in _STATS_CACHE:
+        return _STATS_CACHE[key]
+
+    city, month, day = key
+    # sum and mean both skip missing durations
+    duration = df['Trip Duration'].agg(['sum', 'mean'])
+    stats = {
+        # most common month and day of week are only needed when not filtered by them
+        # this assumes there is only one most common value
+        'month_mode': None if month else _mode_small(df['month'].values - 1, 12) + 1,
+        'dow_mode': None if day else _mode_small(df['day_of_week'].values, 7),
+        'hour_mode': _mode_small(df['hour'].values, 24),
+        'start_mode': df['Start Station'].value_counts().index[0],
+        'end_mode': df['End Station'].value_counts().index[0],
+        # observed=True keeps the categorical groupby to the station pairs actually present
+        'trip_mode': df.groupby(['Start Station', 'End Station'], sort=False, observed=True).size().idxmax(),
+        'total': duration['sum'],
+        'mean': duration['mean'],
+        # categorical counts also list the categories filtered out, so keep only the seen ones
+        'user_counts': df['User Type'].value_counts().loc[lambda counts: counts > 0],
+        'gender_counts': None,
+    }
+    if city in ['chicago', 'new york']:
+        stats['gender_counts'] = df['Gender'].value_counts().loc[lambda counts: counts > 0]
 
-    return df
+    _STATS_CACHE[key] = stats
+    return stats
 
 
-def time_stats(df, filters: tuple):
+def time_stats(stats: dict):
     """Displays statistics on the most frequent times of travel."""
 
     print('\nCalculating The Most Frequent Times of Travel...\n')
-    start_time = time.time()
 
     # display the most common month
-    # this assumes there is only one most common value
-    month, day = filters
-    if not month:
-        month = df['month'].mode().values[0]
-        print(f"Most common month: {calendar.month_name[month]}")
+    if stats['month_mode'] is not None:
+        print(f"Most common month: {calendar.month_name[stats['month_mode']]}")
 
     # display the most common day of week
-    if not day:
-        day = df['day_of_week'].mode().values[0]
-        print(f"Most common day of week: {day}")
+    if stats['dow_mode'] is not None:
+        print(f"Most common day of week: {_DAY_NAMES[stats['dow_mode']]}")
 
     # display the most common start hour
-    hour = df['hour'].mode().values[0]
-    hour_str = datetime.strptime(str(f"{hour}:00"), '%H:%M')
-    localized_hour = datetime.strftime(hour_str, '%I:%M %p')
-    print(f"Most common hour: {localized_hour}")
+    print(f"Most common hour: {_HOUR_LABELS[stats['hour_mode']]}")
 
-    print("\nThis took %s seconds." % (time.time() - start_time))
     print('-' * 60)
 
 
-def station_stats(df):
+def station_stats(stats: dict):
     """Displays statistics on the most popular stations and trip."""
 
     print('\nCalculating The Most Popular Stations and Trip...\n')
-    start_time = time.time()
 
     # display most commonly used start station
-    start_station = df['Start Station'].mode().values
-    print(f"Most commonly used start station: {start_station}")
+    print(f"Most commonly used start station: {stats['start_mode']}")
 
     # display most commonly used end station
-    end_station = df['End Station'].mode().values
-    print(f"Most commonly used end station: {end_station}")
+    print(f"Most commonly used end station: {stats['end_mode']}")
 
     # display most common trip from start to end
-    common_trip = df[['Start Station', 'End Station']].mode().values[0]
+    common_trip = stats['trip_mode']
     print(f"Most common trip from start to end: {common_trip[0]} TO {common_trip[1]}")
 
-    print("\nThis took %s seconds." % (time.time() - start_time))
     print('-' * 60)
 
 
-def trip_duration_stats(df):
+def trip_duration_stats(stats: dict):
     """Displays statistics on the total and average trip duration."""
 
     print('\nCalculating Trip Duration...\n')
-    start_time = time.time()
 
     # display total travel time
-    total = df['Trip Duration'].sum()
-    print(f"Total travel time was: {timedelta(seconds=int(total))}")
+    print(f"Total travel time was: {timedelta(seconds=int(stats['total']))}")
 
     # display mean travel time
-    total_mean = df['Trip Duration'].mean()
-    print(f"Average travel time was: {timedelta(seconds=int(total_mean))}")
+    print(f"Average travel time was: {timedelta(seconds=int(stats['mean']))}")
 
-    print("\nThis took %s seconds." % (time.time() - start_time))
     print('-' * 60)
 
 
-def user_stats(df, city: str):
+def user_stats(stats: dict):
     """Displays statistics on bikeshare users."""
 
     print('\nCalculating User Stats...\n')
-    start_time = time.time()
 
     # Display counts of user types
-    user_types = df['User Type'].value_counts()
-    print(user_types.to_string())
+    print(stats['user_counts'].to_string())
 
     print("\n")
 
     # Display counts of gender
-    if city in ['chicago', 'new york']:
-        user_types = df['Gender'].value_counts()
-        print(user_types.to_string())
+    if stats['gender_counts'] is not None:
+        print(stats['gender_counts'].to_string())
 
-    print("\nThis took %s seconds." % (time.time() - start_time))
     print('-' * 60)
 
 
+def _format_rows(rows):
+    """Formats trip rows for display, showing the day of week code by its name."""
+    if 'day_of_week' in rows:
+        rows = rows.assign(day_of_week=[_DAY_NAMES[day] for day in rows['day_of_week']])
+    return rows.to_string()
+
+
 def display_data(df):
     """ Display trip data on demand """
     print('-' * 60)
-    curr_loc = 0
-    while True:
-        if check_prompt("\nWould you like to view 5 rows of trip data? y/n\n"):
-            print(df.iloc[curr_loc:curr_loc+5])
-            curr_loc += 5
-            continue
-        break
+    # rows are only formatted when the user asks for them
+    chunks = (_format_rows(df.iloc[i:i + 5]) for i in range(0, len(df), 5))
+    for chunk in chunks:
+        if not check_prompt("\nWould you like to view 5 rows of trip data? y/n\n"):
+            break
+        print(chunk)
+    else:
+        print("\nNo more trip data to display.")
 
 
 def main():
+    # city data read so far, changing only the filters reuses it instead of reading it again
+    loaded = {}
     while True:
         print('-' * 60)
         print('Hello! Let\'s explore some US bikeshare data!')
@@ -254,18 +356,27 @@ def main():
 
         city = get_city()
         month, day = get_filters()
-        df = load_data(city)
-        df = filter_data(df, (month, day))
+        if city not in loaded:
+            loaded[city] = read_city(city)
+        df = filter_data(loaded[city], (month, day))
+        # the statistics are all computed here, the *_stats functions only display them
+        key = (city, month, day)
+        cached = key in _STATS_CACHE
+        start_time = time.time()
+        stats = compute_stats(df, key)
+        print("\nComputing the statistics took %s seconds%s." % (time.time() - start_time,
+                                                               " (reused from cache)" if cached else ""))
+        print('-' * 60)
 
-        time_stats(df, (month, day))
-        station_stats(df)
+        time_stats(stats)
+        station_stats(stats)
         if check_prompt("Would you like to see info about trip duration and users? y/n\n"):
-            trip_duration_stats(df)
-            user_stats(df, city)
+            trip_duration_stats(stats)
+            user_stats(stats)
 
         display_data(df)
         restart = input('\nWould you like to restart? Enter yes or no.\n')
-        if restart.lower() in ['n', 'no']:
+        if restart.strip().lower() in _NO:
             input('\nExiting the program...\n')
             break
 